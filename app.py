@@ -15,59 +15,218 @@
 #   limitations under the License.
 
 from pelican_deploy import DeploymentRunner
+from pelican_deploy.deploy import validate_runner_config
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.date import DateTrigger
 from importlib.machinery import SourceFileLoader
 from operator import methodcaller
+from itertools import count
+from threading import Lock, Thread
 from bottle import run, default_app
 from wsgiref.simple_server import make_server
 import pelican_deploy.webhookbottle
 import pelican_deploy.statusbottle
 import logging
 import atexit
+import signal
+import time
 import sys
+import os
 
-def init_app(configpath):
+log = logging.getLogger(__name__)
+
+CONFIG_WATCH_INTERVAL = 5  # seconds
+
+runners = {}
+schedulers = {}
+_configpath = None
+_reload_lock = Lock()
+_job_ids = count()
+
+def _load_config(configpath):
+    return SourceFileLoader("config", configpath).load_module()
+
+def _add_build_job(rname, trigger, i):
+    schedulers[rname].add_job(runners[rname].build,
+                              trigger=trigger,
+                              name="{} ({})".format(rname, i),
+                              id="{}_{}".format(rname, next(_job_ids)),
+                              max_instances=1,
+                              kwargs={"wait": True,
+                                     "ignore_pull_error": True})
+
+def _add_maintenance_job(rname, trigger, i):
+    schedulers[rname].add_job(runners[rname].maintain,
+                              trigger=trigger,
+                              name="{} maintenance ({})".format(rname, i),
+                              id="{}_maintenance_{}".format(rname,
+                                                            next(_job_ids)),
+                              max_instances=1)
+
+def _sync_jobs(scheduled_jobs, added):
+    # scheduled_jobs is a sequence of (add_fn, method name, index in the
+    # config, runner, trigger). Jobs of existing runners are matched by
+    # method and trigger, date triggers are only added for new runners,
+    # otherwise each reload would build
+    unmatched = {rname: [j for j in s.get_jobs()
+                         if not isinstance(j.trigger, DateTrigger)]
+                 for rname, s in schedulers.items() if rname not in added}
 
-    config = SourceFileLoader("config", configpath).load_module()
+    for add_fn, method, i, rname, trigger in scheduled_jobs:
+        if rname in added:
+            add_fn(rname, trigger, i)
+            continue
+        if isinstance(trigger, DateTrigger):
+            continue
+        func = getattr(runners[rname], method)
+        match = next((j for j in unmatched[rname] if j.func == func and
+                      str(j.trigger) == str(trigger)), None)
+        if match:
+            unmatched[rname].remove(match)
+        else:
+            log.info("adding scheduled %s job %s for %s", method, trigger,
+                     rname)
+            add_fn(rname, trigger, i)
 
-    runners = {name: DeploymentRunner(name, conf)
-               for name, conf in config.RUNNERS.items()}
+    for jobs in unmatched.values():
+        for job in jobs:
+            log.info("removing scheduled job %s", job)
+            job.remove()
 
-    for r in runners.values():
-        atexit.register(r.shutdown)  # finally, wait for builds to finish
+def _remove_runner(rname):
+    log.info("removing runner %s", rname)
+    schedulers.pop(rname).shutdown(wait=False)
+    Thread(target=runners.pop(rname).shutdown).start()  # aborts the build
 
-    for r in runners.values():
-        atexit.register(r.try_abort_build)  # then try to abort running builds
+def _validate_config(config):
+    # raises if config can not be applied, before anything is changed
+    for setting in ("RUNNERS", "SCHEDULED_BUILD_JOBS", "GITHUB_SECRET",
+                    "GITLAB_SECRET"):
+        if not hasattr(config, setting):
+            raise ValueError("missing setting {}".format(setting))
 
-    schedulers = {r: BackgroundScheduler(daemon=True) for r in runners}
-    for s in schedulers.values():
-        s.start()
-        atexit.register(s.shutdown, wait=False)  # first stop the schedulers
+    for rname, conf in config.RUNNERS.items():
+        validate_runner_config(rname, conf)
 
-    atexit.register(print,
-                    "<><><><><><><><><><><><><><><><><><><><><><><><><>\n",
-                    ">>>>> Shutting down gracefully, please wait! <<<<<\n",
-                    "<><><><><><><><><><><><><><><><><><><><><><><><><>",
-                    file=sys.stderr, sep="")
+    jobs = [("SCHEDULED_BUILD_JOBS", rname) for rname, _
+            in config.SCHEDULED_BUILD_JOBS]
+    jobs += [("SCHEDULED_MAINTENANCE_JOBS", rname) for rname, _
+             in getattr(config, "SCHEDULED_MAINTENANCE_JOBS", [])]
+    for setting, rname in jobs:
+        if rname not in config.RUNNERS:
+            raise ValueError("{}: unknown runner `{}`".format(setting, rname))
 
-    for i, (rname, trigger) in enumerate(config.SCHEDULED_BUILD_JOBS):
-        schedulers[rname].add_job(runners[rname].build,
-                                  trigger=trigger,
-                                  name="{} ({})".format(rname, i),
-                                  id="{}_{}".format(rname, i),
-                                  max_instances=1,
-                                  kwargs={"wait": True,
-                                         "ignore_pull_error": True})
+def _create_runners(config):
+    added = {}
+    try:
+        for name, conf in config.RUNNERS.items():
+            if name not in runners:
+                added[name] = DeploymentRunner(name, conf)
+    except Exception:
+        for runner in added.values():
+            runner.shutdown()
+        raise
+    return added
+
+def _apply_config(config):
+    # validate and create the new runners first, if that fails nothing was
+    # changed yet
+    _validate_config(config)
+    added = _create_runners(config)
+
+    for rname in set(runners) - set(config.RUNNERS):
+        _remove_runner(rname)
+
+    for rname, conf in config.RUNNERS.items():
+        if rname in runners and conf != runners[rname].runner_config:
+            runners[rname].reconfigure(conf)
+
+    for rname, runner in added.items():
+        runners[rname] = runner
+        schedulers[rname] = BackgroundScheduler(daemon=True)
+        schedulers[rname].start()
+
+    scheduled_jobs = [(_add_build_job, "build", i, rname, trigger)
+                      for i, (rname, trigger)
+                      in enumerate(config.SCHEDULED_BUILD_JOBS)]
+    scheduled_jobs += [(_add_maintenance_job, "maintain", i, rname, trigger)
+                       for i, (rname, trigger) in enumerate(getattr(
+                           config, "SCHEDULED_MAINTENANCE_JOBS", []))]
+    _sync_jobs(scheduled_jobs, added)
 
     pelican_deploy.webhookbottle.set_runners(**runners)
     pelican_deploy.webhookbottle.set_github_secret(config.GITHUB_SECRET)
     pelican_deploy.webhookbottle.set_gitlab_secret(config.GITLAB_SECRET)
-    default_app().mount("/hooks/", pelican_deploy.webhookbottle.app)
 
     pelican_deploy.statusbottle.set_auth_basic_fn(getattr(config,
                                                   "STATUS_AUTH_BASIC_FN", None))
     pelican_deploy.statusbottle.set_runners(**runners)
     pelican_deploy.statusbottle.set_schedulers(**schedulers)
+
+def reload_config():
+    # keeps the build repositories, running builds and the status of
+    # all runners which are still in the config
+    with _reload_lock:
+        log.info("reloading config %s", _configpath)
+        try:
+            _apply_config(_load_config(_configpath))
+        except Exception:
+            log.error("reloading config failed, keeping the old one",
+                      exc_info=True)
+            return False
+    log.info("config reloaded")
+    return True
+
+def _watch_config():
+    mtime = os.stat(_configpath).st_mtime
+    while True:
+        time.sleep(CONFIG_WATCH_INTERVAL)
+        try:
+            new_mtime = os.stat(_configpath).st_mtime
+        except OSError:
+            continue  # e.g. while an editor replaces the file
+        if new_mtime != mtime:
+            mtime = new_mtime
+            reload_config()
+
+def _shutdown():
+    print("<><><><><><><><><><><><><><><><><><><><><><><><><>\n",
+          ">>>>> Shutting down gracefully, please wait! <<<<<\n",
+          "<><><><><><><><><><><><><><><><><><><><><><><><><>",
+          file=sys.stderr, sep="")
+
+    with _reload_lock:  # a reload must not change them meanwhile
+        for s in schedulers.values():
+            s.shutdown(wait=False)  # first stop the schedulers
+
+        # then abort running builds and wait for them to finish, in
+        # parallel so no runner waits for an other one
+        threads = [Thread(target=r.shutdown) for r in runners.values()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+def init_app(configpath):
+    global _configpath
+    _configpath = configpath
+
+    config = _load_config(configpath)
+    _apply_config(config)
+    atexit.register(_shutdown)
+
+    try:
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: Thread(target=reload_config).start())
+    except ValueError:
+        log.info("not in the main thread, SIGHUP does not reload the config")
+
+    if getattr(config, "RELOAD_ON_CONFIG_CHANGE", False):
+        Thread(target=_watch_config, daemon=True).start()
+
+    default_app().mount("/hooks/", pelican_deploy.webhookbottle.app)
+
+    pelican_deploy.statusbottle.set_reload_fn(reload_config)
     default_app().mount("/status/", pelican_deploy.statusbottle.app)
 
     return default_app()
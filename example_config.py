@@ -56,6 +56,29 @@ RUNNERS = {
         # branch which will be built
         "git_branch": "master",
 
+        # optional, if clone_url is a repository on this host, build as soon
+        # as git_branch is updated there (inotify, or polling every 10s if
+        # that is not available). Updates within watch_debounce seconds are
+        # combined into one build
+        #"watch_local_repo": True,
+        #"watch_debounce": 0.5,
+
+        # optional, how the build repository is cloned, changing these
+        # migrates an existing build repository without a fresh clone
+        "clone_options": {
+            # history depth of clone and pulls, None for the full history
+            "depth": 1,
+            # partial clone: None, "blobless" or "treeless"
+            # (the server has to support it)
+            "partial_clone": None,
+            # gitignore style patterns of paths to check out, None for all
+            "sparse_checkout": None,
+            # submodule names or paths (wildcards allowed) to initialize,
+            # None for all, exclude wins over include
+            "submodules_include": None,
+            "submodules_exclude": [],
+        },
+
         # command which installs the generated directory tree to it's final
         # destination (the wwwroot) e.g. rsync. {output} will be replaced by
         # the path to the generator output
@@ -67,8 +90,44 @@ RUNNERS = {
         "build_command": ('tox -e pelican --result-json "{toxresult}" '
                           '--recreate -- -d --output "{output}"'),
 
+        # optional, "subprocess" (default) runs build_command, with
+        # "pelican_worker" pelican is run in a process forked from a warm
+        # worker which already imported pelican and the preload modules, so
+        # interpreter and tox startup are saved. build_command is not needed
+        # then. The worker is restarted if one of the dependencies changed
+        #"build_engine": "pelican_worker",
+        #"pelican_worker": {
+        #    # interpreter of a virtualenv which has pelican installed,
+        #    # default: the one running this program
+        #    "python": "/srv/pelican-venv/bin/python",
+        #    # arguments of the pelican command, {output} as for build_command
+        #    "args": '-s publishconf.py --output "{output}" content',
+        #    # modules to import in advance, e.g. markdown and plugins
+        #    "preload": ["markdown"],
+        #    # files in the repository which invalidate the worker
+        #    "dependencies": ["requirements.txt", "tox.ini", "setup.py"],
+        #},
+
         # will be added to env when running build_command
-        "build_env": {"PELICAN_SITEURL": "//apu:800"}
+        "build_env": {"PELICAN_SITEURL": "//apu:800"},
+
+        # optional, size budget in bytes for keeping outputs of successful
+        # builds, a tree which was built before is then installed without
+        # running build_command again. None or 0 disables the store
+        "artifact_store_size": 1024 ** 3,
+
+        # optional, warn if a build step (build_command or a step from the
+        # tox result) takes that much longer than usual (0.5 = 50%)
+        "timing_regression_threshold": 0.5,
+
+        # optional, seconds to wait after SIGTERM before the processes of an
+        # aborted build (and all their children) are killed
+        "kill_grace_period": 10,
+
+        # optional, run the maintenance (see below) after a build if the
+        # .git directory of the build repository got larger (in bytes). If
+        # it stays larger, it runs again only once .git grew by another 25%
+        "maintenance_threshold": 512 * 1024 ** 2,
     }
 }
 
@@ -80,6 +139,19 @@ SCHEDULED_BUILD_JOBS = [
 
 ]
 
+# same for the maintenance of the runners, it is skipped if a build is
+# running or queued: repack and prune the build repository, remove git dirs
+# of unused submodules, a build output which was not installed and a tox
+# result file the build_command does not write (any more)
+SCHEDULED_MAINTENANCE_JOBS = [
+    ("website_master", CronTrigger(hour="4", minute="15")),
+]
+
+# reload the config when this file changes, it is also reloaded on SIGHUP
+# and from the status page. Build repositories, running builds and the
+# status of unchanged runners are kept
+RELOAD_ON_CONFIG_CHANGE = False
+
 # user, pass for /status/... subpages, if not set or None no auth is done
 def STATUS_AUTH_BASIC_FN(user, passw):
     return user == "powerpoint" and passw == "karaoke"
@@ -0,0 +1,176 @@
+#   Copyright 2016 Peter Dahlberg
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from pathlib import Path
+from pelican_deploy.util import dir_size
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+log = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Content addressed store of build outputs. Every file is stored once under
+# objects/ by its sha256, artifacts/<key>.json lists the files of one output.
+# The mtime of a manifest is used as its last access time for LRU eviction.
+class ArtifactStore:
+
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.max_size = max_size
+        self._objects = self.path / "objects"
+        self._artifacts = self.path / "artifacts"
+        self._objects.mkdir(parents=True, exist_ok=True)
+        self._artifacts.mkdir(parents=True, exist_ok=True)
+        # walking the whole store is expensive, cached until add or evict
+        self._size = None
+        self._count = None
+
+    @staticmethod
+    def make_key(**parts):
+        data = json.dumps(parts, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+
+    def _manifest_path(self, key):
+        return self._artifacts / "{}.json".format(key)
+
+    def _object_path(self, digest):
+        return self._objects / digest[:2] / digest[2:]
+
+    def __contains__(self, key):
+        return self._manifest_path(key).exists()
+
+    def artifacts(self):
+        return sorted(self._artifacts.glob("*.json"),
+                      key=lambda p: p.stat().st_mtime)
+
+    def size(self):
+        if self._size is None:
+            self._size = dir_size(self._objects)
+        return self._size
+
+    def count(self):
+        if self._count is None:
+            self._count = len(self.artifacts())
+        return self._count
+
+    def discard(self, key):
+        # the objects are removed by the next garbage collection
+        try:
+            self._manifest_path(key).unlink()
+        except FileNotFoundError:
+            pass
+        self._count = None
+
+    def add(self, key, src):
+        src = Path(src)
+        manifest = {"files": {}, "links": {}, "dirs": []}
+        for root, dirs, files in os.walk(str(src)):
+            root = Path(root)
+            for d in dirs:
+                if (root / d).is_symlink():
+                    files.append(d)  # os.walk does not follow it
+                else:
+                    manifest["dirs"].append(str((root / d).relative_to(src)))
+            for f in files:
+                fpath = root / f
+                rel = str(fpath.relative_to(src))
+                if fpath.is_symlink():
+                    manifest["links"][rel] = os.readlink(str(fpath))
+                    continue
+                st = fpath.stat()
+                digest = self._store_object(fpath)
+                manifest["files"][rel] = [digest, st.st_mode & 0o7777,
+                                          st.st_mtime]
+
+        tmp = self._manifest_path(key).with_suffix(".tmp")
+        with tmp.open("w") as f:
+            json.dump(manifest, f)
+        tmp.replace(self._manifest_path(key))
+        log.info("stored artifact %s (%s files)", key,
+                 len(manifest["files"]))
+        self._size = self._count = None
+        self.evict()
+
+    def _store_object(self, fpath):
+        h = hashlib.sha256()
+        with fpath.open("rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        obj = self._object_path(digest)
+        if not obj.exists():
+            obj.parent.mkdir(exist_ok=True)
+            tmp = obj.with_name(obj.name + ".tmp")
+            shutil.copyfile(str(fpath), str(tmp))
+            tmp.replace(obj)
+        return digest
+
+    def restore(self, key, dest):
+        # files are copied, not hardlinked: the generator may rewrite
+        # files in the output dir in place
+        manifest_path = self._manifest_path(key)
+        with manifest_path.open() as f:
+            manifest = json.load(f)
+        os.utime(str(manifest_path))  # mark as recently used
+
+        dest = Path(dest)
+        if dest.exists():
+            shutil.rmtree(str(dest))
+        dest.mkdir(parents=True)
+        for d in manifest["dirs"]:
+            (dest / d).mkdir(parents=True, exist_ok=True)
+        for rel, target in manifest["links"].items():
+            os.symlink(target, str(dest / rel))
+        for rel, (digest, mode, mtime) in manifest["files"].items():
+            fpath = dest / rel
+            shutil.copyfile(str(self._object_path(digest)), str(fpath))
+            os.chmod(str(fpath), mode)
+            # keep mtimes, so e.g. rsync --times only transfers real changes
+            os.utime(str(fpath), (time.time(), mtime))
+        log.info("restored artifact %s to %s", key, dest)
+
+    def evict(self):
+        if not self.max_size:
+            return
+        size = self.size()
+        manifests = self.artifacts()
+        # always keep the most recently used artifact
+        while size > self.max_size and len(manifests) > 1:
+            oldest = manifests.pop(0)
+            log.info("evicting artifact %s", oldest.stem)
+            oldest.unlink()
+            size = self._collect_garbage()
+            self._size = size
+            self._count = len(manifests)
+
+    def _collect_garbage(self):
+        referenced = set()
+        for manifest_path in self.artifacts():
+            with manifest_path.open() as f:
+                manifest = json.load(f)
+            referenced.update(d for d, _, _ in manifest["files"].values())
+
+        size = 0
+        for obj in self._objects.glob("*/*"):
+            digest = obj.parent.name + obj.name
+            if digest in referenced:
+                size += obj.stat().st_size
+            else:
+                obj.unlink()
+        return size
@@ -0,0 +1,77 @@
+#   Copyright 2016 Peter Dahlberg
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from collections import namedtuple, OrderedDict
+from statistics import median
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+BuildTiming = namedtuple("BuildTiming", "date steps")
+
+# fewer previous builds are not a meaningful baseline
+MIN_BASELINE_SAMPLES = 3
+
+# tox 4 records `elapsed` per command, some tox 3 versions `duration`
+_DURATION_KEYS = ("elapsed", "duration")
+
+def _duration(entry):
+    for key in _DURATION_KEYS:
+        if isinstance(entry.get(key), (int, float)):
+            return float(entry[key])
+    return None
+
+def _step_kind(phase, command):
+    if phase == "test":
+        return "run"
+    if "install" in command:
+        return "install"
+    return "setup"
+
+def parse_tox_result(path):
+    # returns an OrderedDict of "<testenv> <kind>" -> seconds, kind is one of
+    # setup, install or run; commands without timing information are skipped
+    with open(str(path)) as f:
+        result = json.load(f)
+
+    steps = OrderedDict()
+    for envname, env in result.get("testenvs", {}).items():
+        for phase in ("setup", "test"):
+            for entry in env.get(phase, []):
+                seconds = _duration(entry)
+                if seconds is None:
+                    continue
+                command = entry.get("command") or []
+                key = "{} {}".format(envname, _step_kind(phase, command))
+                steps[key] = steps.get(key, 0.0) + seconds
+        envresult = env.get("result", {})
+        if isinstance(envresult, dict) and _duration(envresult) is not None:
+            steps["{} total".format(envname)] = _duration(envresult)
+    return steps
+
+def find_regressions(timings, current, threshold, baseline_len):
+    # compares the steps of current against the median of the last
+    # baseline_len timings, returns a dict step -> (seconds, baseline)
+    # for every step which got slower by more than threshold (0.5 = 50%)
+    regressions = {}
+    history = list(timings)[-baseline_len:]
+    for step, seconds in current.steps.items():
+        values = [t.steps[step] for t in history if step in t.steps]
+        if len(values) < MIN_BASELINE_SAMPLES:
+            continue
+        baseline = median(values)
+        if baseline > 0 and seconds > baseline * (1 + threshold):
+            regressions[step] = (seconds, baseline)
+    return regressions
@@ -13,15 +13,23 @@
 #   limitations under the License.
 
 from pathlib import Path
-from collections import namedtuple, deque
-from pelican_deploy.gittool import Repo, log_git_result
+from collections import namedtuple, deque, OrderedDict
+from pelican_deploy.gittool import Repo, log_git_result, GitCommandError
 from functools import partial
-from subprocess import Popen, PIPE, check_call
-from pelican_deploy.util import exception_logged
+from subprocess import PIPE, check_call
+from pelican_deploy.util import (exception_logged, dir_size,
+                                 ProcessRegistry, AbortedError)
+from pelican_deploy.artifactstore import ArtifactStore
+from pelican_deploy.pelicanworker import PelicanWorker
+from pelican_deploy.refwatch import RefWatcher, local_git_dir
+from pelican_deploy.buildtiming import (BuildTiming, parse_tox_result,
+                                        find_regressions)
 from concurrent.futures import ThreadPoolExecutor
-from threading import RLock, Thread
+from threading import Lock, RLock, Thread
 from datetime import datetime
+from fnmatch import fnmatch
 import pytz
+import time
 import sys
 import logging
 import shlex
@@ -35,47 +43,200 @@ log_git = partial(log_git_result, out_logger=log.debug,
 TOX_RESULT_FILE = "{name}_result.json"
 BUILD_REPO_DIR = "{name}_build_repo"
 OUTPUT_DIR = "{name}_output"
+ARTIFACT_STORE_DIR = "{name}_artifacts"
 STATUS_LEN = 500
+TIMING_LEN = 100
+TIMING_BASELINE_LEN = 10
+KILL_GRACE_PERIOD = 10
+# if .git is still above maintenance_threshold after the maintenance, the
+# next one is triggered once it grew by this factor (0.25 = 25%)
+MAINTENANCE_REGROWTH = 0.25
+
+BUILD_ENGINES = ("subprocess", "pelican_worker")
+# invalidate the warm pelican worker if one of them changes
+PELICAN_WORKER_DEPENDENCIES = ["requirements.txt", "tox.ini", "setup.py"]
+
+# partial clone strategies, see git-clone(1) --filter
+PARTIAL_CLONE_FILTERS = {None: None, "blobless": "blob:none",
+                         "treeless": "tree:0"}
 
 BuildStatus = namedtuple("BuildStatus", "date ok msg payload running")
+RepoStats = namedtuple("RepoStats", "strategy cloned seconds git_dir_size")
+DiskUsage = namedtuple("DiskUsage", "date build_repo git_dir output artifacts")
 
 class PullError(Exception):
     pass
 
+def validate_runner_config(name, runner_config):
+    # raises ValueError if DeploymentRunner can not be configured with it
+    required = ["working_directory", "clone_url", "git_branch",
+                "final_install_command"]
+    build_engine = runner_config.get("build_engine", "subprocess")
+    if build_engine not in BUILD_ENGINES:
+        raise ValueError("{}: unknown build_engine `{}`".format(
+            name, build_engine))
+    if build_engine == "subprocess":
+        required.append("build_command")
+    missing = [key for key in required if key not in runner_config]
+    if missing:
+        raise ValueError("{}: missing {}".format(name, ", ".join(missing)))
+
+    partial_clone = runner_config.get("clone_options", {}).get(
+        "partial_clone")
+    if partial_clone not in PARTIAL_CLONE_FILTERS:
+        raise ValueError("{}: unknown partial_clone strategy `{}`".format(
+            name, partial_clone))
+
 class DeploymentRunner:
 
     def __init__(self, name, runner_config):
         self.name = name
-        self.working_directory = Path(runner_config["working_directory"])
-        if not self.working_directory.exists():
-            log.info("creating working directory for %s: %s", name,
-                     self.working_directory)
-            self.working_directory.mkdir(parents=True)
-        self.working_directory = self.working_directory.resolve()
-
-        self.clone_url = runner_config["clone_url"]
-        self.git_branch = runner_config["git_branch"]
-        self.build_repo_path = self.working_directory / BUILD_REPO_DIR.format(
-            name=name)
-        outdir = self.working_directory / OUTPUT_DIR.format(name=name)
-        toxresult = self.working_directory / TOX_RESULT_FILE.format(name=name)
-        self.build_command = runner_config["build_command"].format(
-            output=outdir, toxresult=toxresult)
-        self.final_install_command = runner_config["final_install_command"]\
-            .format(output=outdir)
-        self._output_dir = outdir
-
-        self._build_proc_env = dict(os.environ,
-                                    **runner_config.get("build_env", {}))
+        self.repo_stats = None
 
         self._executor = ThreadPoolExecutor(max_workers=1)
         self._futures = set()
-        self._build_proc = None
-        self._abort = False
+        self._processes = ProcessRegistry()
         self._build_lock = RLock()
         self._repo_update_lock = RLock()
+        self._abort_lock = Lock()
+        self._terminating = {}  # process -> thread terminating it
 
         self.build_status = deque(maxlen=STATUS_LEN)
+        self.build_timings = deque(maxlen=TIMING_LEN)
+        self.disk_usage = None
+        self._maintained_git_size = None  # .git size after the maintenance
+        # None if unknown, False while (re)generating or if installing failed
+        self._output_installed = None
+        self.ref_watcher = None
+        self._pelican_worker = None
+
+        try:
+            self._configure(runner_config)
+        except Exception:
+            self.shutdown()  # nothing may be left running
+            raise
+
+    def reconfigure(self, runner_config):
+        # applied between builds: a running build and the builds queued
+        # before this still use the old settings, later ones the new. Not
+        # added to self._futures, so a new build does not cancel it. If it
+        # fails, the old config is kept
+        def configure_job():
+            log.info("%s: reconfiguring runner", self.name)
+            try:
+                exception_logged(self._configure, log.error)(runner_config)
+            except Exception as e:
+                self.update_status(False, "Reloading the configuration failed",
+                                   payload={"exception": e}, running=False)
+                raise
+            self.update_status(True, "Configuration reloaded", running=False)
+
+        return self._executor.submit(configure_job)
+
+    def _configure(self, runner_config):
+        # everything is prepared first and only assigned if nothing failed
+        name = self.name
+        validate_runner_config(name, runner_config)
+        clone_options = runner_config.get("clone_options", {})
+        partial_clone = clone_options.get("partial_clone")
+        build_engine = runner_config.get("build_engine", "subprocess")
+
+        working_directory = Path(runner_config["working_directory"])
+        if not working_directory.exists():
+            log.info("creating working directory for %s: %s", name,
+                     working_directory)
+            working_directory.mkdir(parents=True)
+        working_directory = working_directory.resolve()
+
+        outdir = working_directory / OUTPUT_DIR.format(name=name)
+        toxresult = working_directory / TOX_RESULT_FILE.format(name=name)
+        if build_engine == "subprocess":
+            build_command = runner_config["build_command"].format(
+                output=outdir, toxresult=toxresult)
+            pelican_args = None
+            pelican_worker = None
+        else:
+            build_command = None
+            worker_config = runner_config.get("pelican_worker", {})
+            pelican_args = [arg.format(output=outdir) for arg in
+                            shlex.split(worker_config.get("args", ""))]
+            pelican_worker = PelicanWorker(
+                worker_config.get("python"), worker_config.get("preload", []),
+                worker_config.get("dependencies",
+                                  PELICAN_WORKER_DEPENDENCIES))
+        final_install_command = runner_config["final_install_command"]\
+            .format(output=outdir)
+
+        build_env = runner_config.get("build_env", {})
+        build_proc_env = dict(os.environ, **build_env)
+
+        store_size = runner_config.get("artifact_store_size")
+        artifact_store = None
+        if store_size:
+            artifact_store = ArtifactStore(
+                working_directory / ARTIFACT_STORE_DIR.format(name=name),
+                store_size)
+
+        ref_watcher = self._make_ref_watcher(runner_config)
+
+        self.runner_config = runner_config
+        self.working_directory = working_directory
+        self.clone_url = runner_config["clone_url"]
+        self.git_branch = runner_config["git_branch"]
+
+        self.clone_filter = PARTIAL_CLONE_FILTERS[partial_clone]
+        self.clone_depth = clone_options.get("depth", 1)
+        self.sparse_checkout = clone_options.get("sparse_checkout")
+        self.submodules_include = clone_options.get("submodules_include")
+        self.submodules_exclude = clone_options.get("submodules_exclude", [])
+
+        self.build_repo_path = working_directory / BUILD_REPO_DIR.format(
+            name=name)
+        if self._pelican_worker:
+            self._pelican_worker.stop()  # may use an other interpreter now
+        self.build_engine = build_engine
+        self.build_command = build_command
+        self.pelican_args = pelican_args
+        self._pelican_worker = pelican_worker
+        self.final_install_command = final_install_command
+        self._output_dir = outdir
+        self._tox_result_file = toxresult
+
+        # warn if a build step gets slower than this (0.5 = 50%)
+        self.timing_regression_threshold = runner_config.get(
+            "timing_regression_threshold", 0.5)
+
+        self._build_env = build_env
+        self._build_proc_env = build_proc_env
+
+        # seconds between SIGTERM and SIGKILL when aborting a build
+        self.kill_grace_period = runner_config.get("kill_grace_period",
+                                                   KILL_GRACE_PERIOD)
+
+        # .git size in bytes which triggers maintenance after a build
+        self.maintenance_threshold = runner_config.get("maintenance_threshold")
+
+        self.artifact_store = artifact_store
+
+        # last, it may start a build right away
+        if self.ref_watcher:
+            self.ref_watcher.stop()
+        self.ref_watcher = ref_watcher.start() if ref_watcher else None
+
+    def _make_ref_watcher(self, runner_config):
+        # not started yet
+        if not runner_config.get("watch_local_repo"):
+            return None
+        clone_url = runner_config["clone_url"]
+        git_dir = local_git_dir(clone_url)
+        if not git_dir:
+            log.warning("%s: clone_url %s is not a local repository, "
+                        "can not watch it", self.name, clone_url)
+            return None
+        return RefWatcher(git_dir, runner_config["git_branch"],
+                          partial(self.build, abort_running=True,
+                                  ignore_pull_error=True),
+                          debounce=runner_config.get("watch_debounce", 0.5))
 
     def clean_working_dir(self, abort_running=True):
         Thread(target=self.clean_working_dir_blocking).start()
@@ -113,19 +274,146 @@ class DeploymentRunner:
             log.info("Working dir cleand!")
             self.update_status(True, "Working dir cleand!", running=False)
 
+    def maintain(self):
+        # only if idle, a build started later cancels the queued maintenance
+        with self._build_lock:
+            if any(not fut.done() for fut in self._futures):
+                log.info("%s: busy, skipping maintenance", self.name)
+                return None
+            return self._submit_maintenance()
+
+    def _submit_maintenance(self):
+        def maintenance_job():
+            log.info("%s: starting maintenance", self.name)
+            self.update_status(True, "Starting maintenance", running=False)
+            self._processes.reopen()
+            try:
+                self._maintenance_blocking()
+            except Exception as e:
+                # aborted git commands fail or raise AbortedError
+                if self._processes.aborted:
+                    log.info("%s: maintenance aborted", self.name)
+                    self.update_status(False, "Maintenance aborted",
+                                       running=False)
+                    return
+                log.error("%s: maintenance failed", self.name, exc_info=True)
+                self.update_status(False, "Maintenance failed!",
+                                   running=False, payload={"exception": e})
+                raise
+            self.update_status(True, "Finished maintenance", running=False,
+                               payload=self.disk_usage._asdict())
+
+        future = self._executor.submit(maintenance_job)
+        self._futures.add(future)
+        return future
+
+    def _maintenance_blocking(self):
+        # keep the installed output, incremental installs (e.g. rsync) need
+        # it. A partial or not installed one is regenerated anyway
+        if self._output_installed is False:
+            log.info("%s: removing output which was not installed", self.name)
+            check_call(["rm", "-rf", str(self._output_dir)])
+        if "{toxresult}" not in self.runner_config.get("build_command", "") \
+                or self.build_engine != "subprocess":
+            log.info("%s: removing orphaned tox result", self.name)
+            check_call(["rm", "-f", str(self._tox_result_file)])
+        if self.artifact_store:
+            self.artifact_store.evict()
+
+        # not there before the first clone or after cleaning the working dir
+        with self._repo_update_lock:
+            if self.build_repo_path.is_dir():
+                # registered, so the abort link and a new build stop them
+                repo = Repo(str(self.build_repo_path),
+                            processes=self._processes)
+                if repo.is_repo():
+                    self._maintain_build_repo(repo)
+
+        self._maintained_git_size = self.update_disk_usage().git_dir
+
+    def _needs_maintenance(self, git_dir_size):
+        if not self.maintenance_threshold:
+            return False
+        limit = self.maintenance_threshold
+        if self._maintained_git_size:
+            limit = max(limit, self._maintained_git_size *
+                        (1 + MAINTENANCE_REGROWTH))
+        return git_dir_size > limit
+
+    def _maintain_build_repo(self, repo):
+        log.info("%s build_repo: pruning unused submodules", self.name)
+        modules_dir = self.build_repo_path / ".git" / "modules"
+        keep = {modules_dir / name
+                for name, _ in self._selected_submodules(repo)}
+        if modules_dir.is_dir():
+            self._prune_submodule_git_dirs(modules_dir, keep)
+
+        # the forced shallow fetches leave the old commits in the reflogs
+        log.info("%s build_repo: repack and prune", self.name)
+        result = repo.reflog("expire", "--expire=now", "--all")
+        log_git(result)
+        result = repo.repack("-a", "-d", "-l", "-q")
+        log_git(result)
+        result = repo.prune("--expire=now")
+        log_git(result)
+        result = repo.commit_graph("write", "--reachable")
+        log_git(result)
+
+        result = repo.submodule("foreach", "--recursive",
+                                "git gc --quiet --prune=now")
+        log_git(result)
+
+    def _prune_submodule_git_dirs(self, path, keep):
+        for d in path.iterdir():
+            if d in keep or not d.is_dir():
+                continue
+            if (d / "HEAD").exists():
+                log.info("%s build_repo: removing git dir of submodule %s",
+                         self.name, d.relative_to(path))
+                check_call(["rm", "-rf", str(d)])
+            else:
+                # submodule names may contain slashes
+                self._prune_submodule_git_dirs(d, keep)
+
+    def update_disk_usage(self):
+        date = pytz.utc.localize(datetime.utcnow())
+        store = self.artifact_store.path if self.artifact_store else None
+        self.disk_usage = DiskUsage(date, dir_size(self.build_repo_path),
+                                    dir_size(self.build_repo_path / ".git"),
+                                    dir_size(self._output_dir),
+                                    dir_size(store) if store else 0)
+        return self.disk_usage
+
     def update_status(self, ok, msg, payload=None, running=True):
         date = pytz.utc.localize(datetime.utcnow())
         self.build_status.append(BuildStatus(date, ok, msg, payload, running))
 
+    def clone_strategy(self):
+        return {"depth": self.clone_depth, "filter": self.clone_filter,
+                "sparse_checkout": self.sparse_checkout,
+                "submodules_include": self.submodules_include,
+                "submodules_exclude": self.submodules_exclude}
+
     def update_build_repository(self):
         with self._repo_update_lock:
-            self._update_build_repository()
+            start = time.monotonic()
+            cloned = False
+            try:
+                cloned = self._update_build_repository()
+            finally:
+                seconds = time.monotonic() - start
+                size = dir_size(self.build_repo_path / ".git")
+                self.repo_stats = RepoStats(self.clone_strategy(), cloned,
+                                            seconds, size)
+                log.info("%s build_repo: update took %.1fs, .git is %s bytes",
+                         self.name, seconds, size)
 
     def _update_build_repository(self):
+        cloned = False
         if not self.build_repo_path.exists():
             self.build_repo_path.mkdir(parents=True)
 
-        repo = Repo(str(self.build_repo_path))
+        repo = Repo(str(self.build_repo_path), processes=self._processes)
         if not repo.is_repo():
             if self.build_repo_path.is_dir() and \
                     next(self.build_repo_path.iterdir(), None) is not None:
@@ -137,10 +425,14 @@ class DeploymentRunner:
             else:
                 log.info("Build repository %s not there, cloning",
                          self.build_repo_path)
-                result = repo.clone("--branch", self.git_branch,
-                                    "--depth", "1", self.clone_url, ".")
+                args = ["--branch", self.git_branch, "--no-checkout"]
+                if self.clone_depth:
+                    args += ["--depth", str(self.clone_depth)]
+                if self.clone_filter:
+                    args += ["--filter", self.clone_filter]
+                result = repo.clone(*args, self.clone_url, ".")
                 log_git(result)
-
+                cloned = True
 
         origin_url = repo.config_get("remote.origin.url")
         if origin_url != self.clone_url:
@@ -148,10 +440,14 @@ class DeploymentRunner:
                      adjusting...", self.name, origin_url, self.clone_url)
             repo.config("remote.origin.url", self.clone_url)
 
+        self._apply_clone_strategy(repo)
+
         # deinit submodules to avoid removed ones dangling around later
         # they should stay around in .git, so reinit should be fast
-        result = repo.submodule("deinit", "--force", ".")
-        log_git(result)
+        # (a fresh clone has nothing checked out yet)
+        if (self.build_repo_path / ".git" / "index").exists():
+            result = repo.submodule("deinit", "--force", ".")
+            log_git(result)
 
         result = repo.checkout("--force", self.git_branch)
         log_git(result)
@@ -162,8 +458,13 @@ class DeploymentRunner:
         log.info("%s build_repo: pulling changes from origin", self.name)
         refspec = "+{b}:{b}".format(b=self.git_branch)
         try:
-            result = repo.pull("--force", "--recurse-submodules",
-                               "--depth", "1", "origin", refspec)
+            depth = ("--depth", str(self.clone_depth)) if self.clone_depth \
+                else ()
+            # pull can not recurse into submodules outside the sparse
+            # checkout, the submodule update below fetches what it needs
+            recurse = "--no-recurse-submodules" if self.sparse_checkout \
+                else "--recurse-submodules"
+            result = repo.pull("--force", recurse, *depth, "origin", refspec)
             log_git(result)
         except Exception as e:
             # need to reinit the submodules
@@ -178,13 +479,81 @@ class DeploymentRunner:
 
         # update the submodules
         self._update_build_repo_submodules(repo)
+        return cloned
+
+    def _apply_clone_strategy(self, repo):
+        # migrates an existing build repo to the configured strategy in place,
+        # missing objects will be fetched lazily from the promisor remote
+        try:
+            old_filter = repo.config_get("remote.origin.partialclonefilter")
+        except GitCommandError:
+            old_filter = None
+        if self.clone_filter and old_filter != self.clone_filter:
+            log.info("%s build_repo: switching to partial clone filter %s",
+                     self.name, self.clone_filter)
+            repo.config("core.repositoryformatversion", "1")
+            repo.config("extensions.partialClone", "origin")
+            repo.config("remote.origin.promisor", "true")
+            repo.config("remote.origin.partialclonefilter", self.clone_filter)
+        elif not self.clone_filter and old_filter:
+            # keep the promisor, objects left out so far are still missing
+            log.info("%s build_repo: disabling partial clone filter",
+                     self.name)
+            repo.config("--unset", "remote.origin.partialclonefilter")
+
+        if not self.clone_depth and \
+                repo.rev_parse("--is-shallow-repository").stdout.startswith(
+                    "true"):
+            log.info("%s build_repo: fetching full history", self.name)
+            result = repo.fetch("--unshallow", "origin")
+            log_git(result)
+
+        if self.sparse_checkout:
+            result = repo.sparse_checkout("set", "--no-cone",
+                                          *self.sparse_checkout)
+            log_git(result)
+        elif repo.config("--get", "core.sparseCheckout",
+                         errors_raise=False).stdout.startswith("true"):
+            log.info("%s build_repo: disabling sparse checkout", self.name)
+            result = repo.sparse_checkout("disable")
+            log_git(result)
+
+    def _selected_submodules(self, repo):
+        # read .gitmodules from HEAD, it may be left out by a sparse checkout
+        result = repo.config("--blob", "HEAD:.gitmodules", "--get-regexp",
+                             r"^submodule\..*\.path$", errors_raise=False)
+        selected = []
+        for line in result.stdout.splitlines():
+            key, path = line.split(" ", 1)
+            name = key[len("submodule."):-len(".path")]
+            def matches(patterns):
+                return any(fnmatch(name, p) or fnmatch(path, p)
+                           for p in patterns)
+            if self.submodules_include is not None and \
+                    not matches(self.submodules_include):
+                continue
+            if matches(self.submodules_exclude):
+                continue
+            selected.append((name, path))
+        return selected
 
     def _update_build_repo_submodules(self, repo):
+        if self.submodules_include is None and not self.submodules_exclude:
+            paths = []  # no pathspec means all of them
+        else:
+            paths = [path for _, path in self._selected_submodules(repo)]
+            if not paths:
+                log.info("%s build_repo: no submodules selected", self.name)
+                return
+
         log.info("%s build_repo: update submodules", self.name)
         # we must update the urls if changed!
-        result = repo.submodule("sync", "--recursive")
+        result = repo.submodule("sync", "--recursive", "--", *paths)
         log_git(result)
-        result = repo.submodule("update", "--init", "--force", "--recursive")
+        args = ["--init", "--force", "--recursive"]
+        if self.clone_filter:
+            args += ["--filter", self.clone_filter]
+        result = repo.submodule("update", *args, "--", *paths)
         log_git(result)
 
     def build(self, abort_running=False, wait=False, ignore_pull_error=False,
@@ -207,6 +576,8 @@ class DeploymentRunner:
                 build_func = exception_logged(build_fn, log.error)
                 try:
                     build_func()
+                except AbortedError:
+                    self.update_status(False, "Build aborted", running=False)
                 except Exception as e:
                     self.update_status(False, "Build stopped with exception",
                                        running=False, payload={"exception": e})
@@ -217,27 +588,65 @@ class DeploymentRunner:
         if wait:
             return future.result()
 
-    def try_abort_build(self):
-        proc = self._build_proc
-        self._abort = True
-        if proc:
-            try:
-                proc.kill()
-            except:
-                log.debug("unable to kill", exc_info=True)
+    def try_abort_build(self, wait=False):
+        # stops git, build_command and final_install_command including all
+        # their children, until the next build no processes are started
+        # processes which are terminated already by an earlier abort are
+        # left to it, they are signaled and reported only once
+        with self._abort_lock:
+            procs = self._processes.abort()
+            threads = {self._terminating[p] for p in procs
+                       if p in self._terminating}
+            procs = [p for p in procs if p not in self._terminating]
+            if procs:
+                thread = Thread(target=self._terminate_processes,
+                                args=(procs,))
+                self._terminating.update((p, thread) for p in procs)
+                threads.add(thread)
+                thread.start()
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _terminate_processes(self, procs):
+        try:
+            result = self._processes.terminate(procs, self.kill_grace_period)
+        finally:
+            with self._abort_lock:
+                for p in procs:
+                    self._terminating.pop(p, None)
+        log.info("%s: terminated processes: %s", self.name, result)
+        # usually reported after the aborted build ended, only running if a
+        # new job was started or the aborted one did not finish yet (it then
+        # reports its end later on)
+        running = any(not fut.done() for fut in list(self._futures))
+        if "not terminated" in result.values():
+            self.update_status(False, "Aborting: processes not terminated",
+                               payload={"processes": result}, running=running)
+        else:
+            self.update_status(True, "Aborting: all processes terminated",
+                               payload={"processes": result}, running=running)
+
+    def running_processes(self):
+        return self._processes.running()
 
     def final_install(self):
         args = shlex.split(self.final_install_command)
         self.update_status(True, "Starting final_install",
                            payload={"cmd": args})
         log.info("%s: Starting final_install `%s`", self.name, args)
-        proc = Popen(args, stdout=PIPE, stderr=PIPE, universal_newlines=True,
-                     start_new_session=True)
-        outs, errs = proc.communicate()
-        status = proc.wait()
+        status, outs, errs = self._processes.run(args, stdout=PIPE,
+                                                 stderr=PIPE,
+                                                 universal_newlines=True)
+        self._output_installed = status == 0
 
         if status < 0:
             log.info("%s: killed final_install_command (%s)", self.name, status)
+            self.update_status(False, ("killed final_install_command."
+                               " Website may be broken!"),
+                               payload={"status": status,
+                                        "stdout": outs, "stderr": errs})
+            return
         else:
             log.info("%s: finished final_install_command with status %s!",
                         self.name, status)
@@ -256,12 +665,14 @@ class DeploymentRunner:
                                payload={"stdout": outs, "stderr": errs})
 
     def _build_blocking(self, ignore_pull_error=False):
-        self._abort = False
+        self._processes.reopen()
 
         # preparing build environment
         try:
             self.update_status(True, "Start updating repository")
             self.update_build_repository()
+            self.update_status(True, "Finished updating repository",
+                               payload=self.repo_stats._asdict())
         except PullError:
             if ignore_pull_error:
                 msg = "Git pull failed, trying to continue with what we have"
@@ -271,41 +682,144 @@ class DeploymentRunner:
                 raise
 
         # start the build if we should not abort
-        if not self._abort:
-            args = shlex.split(self.build_command)
-            self.update_status(True, "Starting the main build command",
-                               payload={"cmd": args})
-            log.info("%s: Starting build_command `%s`", self.name, args)
-            self._build_proc = Popen(args, stdout=PIPE, stderr=PIPE,
-                                     cwd=str(self.build_repo_path),
-                                     env=self._build_proc_env,
-                                     universal_newlines=True,
-                                     start_new_session=True)
-            outs, errs = self._build_proc.communicate()
-            status = self._build_proc.wait()
-            self._build_proc = None
-
-            if status < 0:
-                self.update_status(False, "killed build_command")
-                log.info("%s: killed build_command", self.name)
-            else:
-                log.info("%s: finished build_command with status %s!",
-                         self.name, status)
-                log.info('%s build_command stdout: %s\n', self.name, outs)
-                log.info('%s build_command stderr: %s\n', self.name, errs)
-            if status == 0:
-                self.update_status(True, "finished build_command",
-                                   payload={"stdout": outs, "stderr": errs})
+        if not self._processes.aborted:
+            key = self._artifact_key() if self.artifact_store else None
+            if key and key in self.artifact_store and \
+                    self._restore_output(key):
                 self.final_install()
             else:
-                self.update_status(False, "build_command failed",
-                                   payload={"status": status,
-                                   "stdout": outs, "stderr": errs})
+                self._run_build_command(key)
 
             self.update_status(self.build_status[-1].ok, "End of build",
                                running=False)
 
+        usage = self.update_disk_usage()
+        if self._needs_maintenance(usage.git_dir):
+            log.info("%s: .git has %s bytes, scheduling maintenance",
+                     self.name, usage.git_dir)
+            self._submit_maintenance()
+
+    def _run_build_command(self, artifact_key=None):
+        if self._pelican_worker:
+            args = ["pelican"] + self.pelican_args
+        else:
+            args = shlex.split(self.build_command)
+        self.update_status(True, "Starting the main build command",
+                           payload={"cmd": args, "engine": self.build_engine})
+        log.info("%s: Starting build_command `%s`", self.name, args)
+        self._output_installed = False
+        try:
+            self._tox_result_file.unlink()  # do not read a stale one later
+        except FileNotFoundError:
+            pass
+        start = time.monotonic()
+        if self._pelican_worker:
+            status, outs, errs = self._pelican_worker.run(
+                self.build_repo_path, self.pelican_args,
+                self._build_proc_env, self._processes)
+        else:
+            status, outs, errs = self._processes.run(
+                args, stdout=PIPE, stderr=PIPE, cwd=str(self.build_repo_path),
+                env=self._build_proc_env, universal_newlines=True)
+        seconds = time.monotonic() - start
+
+        if status < 0:
+            self.update_status(False, "killed build_command")
+            log.info("%s: killed build_command", self.name)
+        else:
+            log.info("%s: finished build_command with status %s!",
+                     self.name, status)
+            log.info('%s build_command stdout: %s\n', self.name, outs)
+            log.info('%s build_command stderr: %s\n', self.name, errs)
+        if status == 0:
+            self.update_status(True, "finished build_command",
+                               payload={"stdout": outs, "stderr": errs})
+            self.final_install()
+            self._record_timing(seconds)
+            if artifact_key:
+                self._archive_output(artifact_key)
+        else:
+            self.update_status(False, "build_command failed",
+                               payload={"status": status,
+                               "stdout": outs, "stderr": errs})
+
+    def _record_timing(self, seconds):
+        # the site is already deployed, a failure here is not fatal
+        try:
+            self._add_build_timing(seconds)
+        except Exception:
+            log.warning("%s: recording the build timing failed", self.name,
+                        exc_info=True)
+
+    def _add_build_timing(self, seconds):
+        steps = OrderedDict(build_command=seconds)
+        if self._tox_result_file.exists():
+            try:
+                steps.update(parse_tox_result(self._tox_result_file))
+            except (OSError, ValueError):
+                log.warning("%s: unable to read tox result %s", self.name,
+                            self._tox_result_file, exc_info=True)
+
+        date = pytz.utc.localize(datetime.utcnow())
+        timing = BuildTiming(date, steps)
+        regressions = find_regressions(self.build_timings, timing,
+                                       self.timing_regression_threshold,
+                                       TIMING_BASELINE_LEN)
+        self.build_timings.append(timing)
+        if regressions:
+            log.warning("%s: build got slower than the baseline: %s",
+                        self.name, regressions)
+            self.update_status(True, "Warning: build slower than baseline",
+                               payload={step: {"seconds": s, "baseline": b}
+                                        for step, (s, b)
+                                        in regressions.items()})
+
+    def _artifact_key(self):
+        # everything which determines the generated output
+        repo = Repo(str(self.build_repo_path), processes=self._processes)
+        tree = repo.rev_parse("HEAD^{tree}").stdout.strip()
+        result = repo.submodule("status", "--recursive")
+        submodules = [[line[0]] + line[1:].split()[:2]
+                      for line in result.stdout.splitlines()]
+        return ArtifactStore.make_key(tree=tree, submodules=submodules,
+                                      sparse_checkout=self.sparse_checkout,
+                                      build_command=self.build_command,
+                                      pelican_args=self.pelican_args,
+                                      build_env=self._build_env)
+
+    def _restore_output(self, key):
+        # returns False if the artifact is broken, it is dropped then
+        log.info("%s: output of this tree is in the artifact store, "
+                 "skipping build_command", self.name)
+        self.update_status(True, "Restoring output from artifact store",
+                           payload={"key": key})
+        self._output_installed = False
+        try:
+            self.artifact_store.restore(key, self._output_dir)
+        except Exception as e:
+            log.warning("%s: restoring artifact %s failed, building instead",
+                        self.name, key, exc_info=True)
+            self.update_status(True, "Restoring failed, building instead",
+                               payload={"key": key, "exception": e})
+            self.artifact_store.discard(key)
+            return False
+        return True
+
+    def _archive_output(self, key):
+        # the site is already deployed, a failure here is not fatal
+        try:
+            self.artifact_store.add(key, self._output_dir)
+        except Exception:
+            log.warning("%s: archiving output failed", self.name,
+                        exc_info=True)
 
     def shutdown(self):
+        if self.ref_watcher:
+            self.ref_watcher.stop()
+        # cancel the queued jobs first, else the next one starts (and
+        # deploys) as soon as the running build is aborted
+        self._executor.shutdown(wait=False, cancel_futures=True)
         self.try_abort_build()
         self._executor.shutdown(wait=True)
+        if self._pelican_worker:
+            self._pelican_worker.stop()
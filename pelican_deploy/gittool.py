@@ -27,13 +27,16 @@ class GitCommandError(Exception):
 
 
 class Repo:
-    def __init__(self, repo_dir, git_cmd="git", default_timeout=None):
+    def __init__(self, repo_dir, git_cmd="git", default_timeout=None,
+                 processes=None):
         if not os.path.exists(repo_dir):
             raise FileNotFoundError(errno.ENOENT, "Path, does not exist",
                                     repo_dir)
         self.repo_dir = repo_dir
         self.git_cmd = git_cmd
         self.default_timeout = default_timeout
+        # optional util.ProcessRegistry, makes the git commands abortable
+        self.processes = processes
 
     def __getattr__(self, name):
         name = name.replace("_", "-")
@@ -46,14 +49,22 @@ class Repo:
             errors_raise=True):
         timeout = timeout if timeout else self.default_timeout
         proc = self.popen_cmd(*args, env=env)
-        outs, errs = proc.communicate(timeout=timeout)
-        status = proc.wait()
+        try:
+            outs, errs = proc.communicate(timeout=timeout)
+            status = proc.wait()
+        finally:
+            if self.processes:
+                self.processes.release(proc)
         res = CmdResult(args,status, outs, errs)
         if status != 0 and errors_raise:
             raise GitCommandError("git failed: {}".format(args), res)
         return res
 
     def popen_cmd(self, *args, env=None, universal_newlines=True):
+        if self.processes:
+            return self.processes.popen(args, stdout=PIPE, stderr=PIPE,
+                                        cwd=self.repo_dir, env=env,
+                                        universal_newlines=universal_newlines)
         return Popen(args, stdout=PIPE, stderr=PIPE, cwd=self.repo_dir, env=env,
                      universal_newlines=universal_newlines,
                      start_new_session=True)
@@ -0,0 +1,177 @@
+#   Copyright 2016 Peter Dahlberg
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from pathlib import Path
+from subprocess import Popen, PIPE, TimeoutExpired
+from tempfile import TemporaryDirectory
+from threading import Lock
+from pelican_deploy.util import AbortedError
+import hashlib
+import json
+import logging
+import os
+import signal
+import sys
+
+log = logging.getLogger(__name__)
+
+SERVER_SCRIPT = str(Path(__file__).with_name("pelicanworker_main.py"))
+STOP_TIMEOUT = 5
+# entries of a sys.path directory which change if a distribution is
+# installed, upgraded or removed
+INSTALL_METADATA = (".dist-info", ".egg-info", ".egg-link", ".pth")
+
+class WorkerError(Exception):
+    pass
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class _ForkedProcess:
+    # stands in for a Popen in a util.ProcessRegistry, the child is reaped
+    # by the fork server
+    def __init__(self, pid, args):
+        self.pid = pid
+        self.args = args
+
+    def poll(self):
+        return None
+
+class PelicanWorker:
+    # Keeps a fork server (pelicanworker_main.py) running with pelican and
+    # the preload modules already imported, every build runs in a fresh
+    # child forked from it. The server is restarted if the interpreter, the
+    # installed distributions, the sources of the preloaded modules or one
+    # of the dependency files in the build repository changed.
+
+    def __init__(self, python=None, preload=(), dependencies=()):
+        self.python = python or sys.executable
+        self.preload = list(preload)
+        self.dependencies = list(dependencies)
+        self._proc = None
+        self._fingerprint = None
+        self._sys_path = []
+        self._module_files = []
+        self._lock = Lock()
+
+    def _dependency_fingerprint(self, repo_path):
+        h = hashlib.sha256()
+        h.update(str(os.stat(self.python).st_mtime).encode())
+        for dep in self.dependencies:
+            h.update(dep.encode())
+            path = Path(repo_path) / dep
+            if path.is_file():
+                h.update(path.read_bytes())
+        # the installed distributions, as reported by the running server
+        for d in self._sys_path:
+            try:
+                names = sorted(n for n in os.listdir(d)
+                               if n.endswith(INSTALL_METADATA))
+            except OSError:
+                names = []
+            h.update("{}:{}".format(d, names).encode())
+        # sources of the preloaded modules, whole packages
+        for f in self._module_files:
+            h.update(str(_mtime(f)).encode())
+            if os.path.basename(f).startswith("__init__."):
+                for root, _, files in os.walk(os.path.dirname(f)):
+                    for name in sorted(files):
+                        if name.endswith(".py"):
+                            path = os.path.join(root, name)
+                            h.update("{}:{}".format(path,
+                                                    _mtime(path)).encode())
+        return h.hexdigest()
+
+    def _receive(self):
+        line = self._proc.stdout.readline()
+        if not line:
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+            raise WorkerError("pelican worker died")
+        return json.loads(line)
+
+    def _start(self):
+        log.info("starting pelican worker %s (preload: %s)", self.python,
+                 self.preload)
+        self._proc = Popen([self.python, SERVER_SCRIPT] + self.preload,
+                           stdin=PIPE, stdout=PIPE, universal_newlines=True,
+                           start_new_session=True)
+        ready = self._receive()
+        if ready["errors"]:
+            log.warning("pelican worker could not preload: %s",
+                        ready["errors"])
+        self._sys_path = ready["path"]
+        self._module_files = sorted(ready["modules"].values())
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+
+    def _stop(self):
+        if not self._proc:
+            return
+        log.info("stopping pelican worker %s", self._proc.pid)
+        self._proc.stdin.close()  # makes the server exit
+        try:
+            self._proc.wait(timeout=STOP_TIMEOUT)
+        except TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc = None
+
+    def _ensure_started(self, repo_path):
+        fingerprint = self._dependency_fingerprint(repo_path)
+        if self._proc and self._proc.poll() is None and \
+                fingerprint == self._fingerprint:
+            return
+        if self._proc:
+            log.info("pelican worker is outdated, restarting")
+            self._stop()
+        self._start()
+        # now including what the server reported
+        self._fingerprint = self._dependency_fingerprint(repo_path)
+
+    def run(self, cwd, argv, env, processes):
+        # runs pelican with argv in cwd, the forked child is registered in
+        # processes (a util.ProcessRegistry) so it can be aborted like a
+        # subprocess. Returns (status, stdout, stderr)
+        with self._lock, TemporaryDirectory() as tmp:
+            self._ensure_started(cwd)
+            request = {"cwd": str(cwd), "argv": argv, "env": env,
+                       "stdout": os.path.join(tmp, "stdout"),
+                       "stderr": os.path.join(tmp, "stderr")}
+            self._proc.stdin.write(json.dumps(request) + "\n")
+            self._proc.stdin.flush()
+
+            child = _ForkedProcess(self._receive()["pid"], ["pelican"] + argv)
+            try:
+                processes.add(child)
+            except AbortedError:
+                os.kill(child.pid, signal.SIGKILL)
+                self._receive()
+                raise
+            try:
+                status = self._receive()["status"]
+            finally:
+                processes.release(child)
+
+            with open(request["stdout"], errors="replace") as f:
+                outs = f.read()
+            with open(request["stderr"], errors="replace") as f:
+                errs = f.read()
+        return status, outs, errs
@@ -0,0 +1,104 @@
+#   Copyright 2016 Peter Dahlberg
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Fork server for pelican builds, see pelicanworker.PelicanWorker. It is run
+# as a script with the interpreter of the pelican virtualenv, so only the
+# standard library may be used here.
+#
+# usage: pelicanworker_main.py [module to preload ...]
+#
+# Protocol (one json object per line): after importing pelican and the
+# preload modules {"ready": true, "errors": {module: error}, "modules":
+# {module: file}, "path": [directories in sys.path]} is written to stdout.
+# Then for every request {"cwd", "argv", "env", "stdout", "stderr"}
+# read from stdin, a child is forked which runs pelican with argv in cwd,
+# {"pid": pid} is written when it started and {"status": status} when it
+# finished (negative for the number of the signal which killed it).
+
+import importlib
+import json
+import os
+import sys
+import traceback
+
+
+def _preload(modules):
+    errors = {}
+    files = {}
+    for name in ["pelican"] + modules:
+        try:
+            module = importlib.import_module(name)
+        except Exception as e:
+            errors[name] = repr(e)
+            continue
+        if getattr(module, "__file__", None):
+            files[name] = os.path.abspath(module.__file__)
+    return errors, files
+
+def _run_pelican(request):
+    # in the forked child, in its own session so it can be killed as group
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    out = os.open(request["stdout"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    err = os.open(request["stderr"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(out, 1)
+    os.dup2(err, 2)
+
+    status = 1
+    try:
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = ["pelican"] + request["argv"]
+        import pelican
+        pelican.main()
+        status = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+def _send(obj):
+    sys.stdout.write(json.dumps(obj) + "\n")
+    sys.stdout.flush()
+
+def main(modules):
+    # the directory of this script must not shadow modules of the site
+    if sys.path[0] == os.path.dirname(os.path.abspath(__file__)):
+        del sys.path[0]
+    errors, files = _preload(modules)
+    paths = [os.path.abspath(p) for p in sys.path if p and os.path.isdir(p)]
+    _send({"ready": True, "errors": errors, "modules": files, "path": paths})
+    for line in sys.stdin:
+        request = json.loads(line)
+        pid = os.fork()
+        if pid == 0:
+            _run_pelican(request)
+        _send({"pid": pid})
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            _send({"status": -os.WTERMSIG(status)})
+        else:
+            _send({"status": os.WEXITSTATUS(status)})
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
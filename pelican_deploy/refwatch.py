@@ -0,0 +1,180 @@
+#   Copyright 2016 Peter Dahlberg
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from pathlib import Path
+from threading import Thread
+from pelican_deploy.gittool import Repo
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+
+log = logging.getLogger(__name__)
+
+# see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+_EVENT_HEADER = struct.Struct("iIII")
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+def local_git_dir(clone_url):
+    # the git dir of clone_url if it is a repository on this host, else None
+    if clone_url.startswith("file://"):
+        path = Path(clone_url[len("file://"):])
+    elif "://" in clone_url or ":" in clone_url.split("/", 1)[0]:
+        return None  # remote, also scp like user@host:path
+    else:
+        path = Path(clone_url)
+
+    if (path / "HEAD").is_file() and (path / "refs").is_dir():
+        return path.resolve()  # bare repository
+    if (path / ".git" / "HEAD").is_file():
+        return (path / ".git").resolve()
+    return None
+
+def _inotify_init():
+    # returns (libc, fd) or None if inotify is not available
+    libname = ctypes.util.find_library("c")
+    if not libname:
+        return None
+    try:
+        libc = ctypes.CDLL(libname, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        log.debug("inotify_init1 failed: %s",
+                  os.strerror(ctypes.get_errno()))
+        return None
+    return libc, fd
+
+class RefWatcher:
+    # Calls callback (debounced) whenever branch of the local repository in
+    # git_dir points to a new commit. Uses inotify on the directory of the
+    # branch ref and on git_dir (for packed-refs), both are updated by
+    # renaming a lock file. Falls back to polling if inotify is not there.
+
+    def __init__(self, git_dir, branch, callback, debounce=0.5,
+                 poll_interval=10):
+        self.git_dir = Path(git_dir)
+        self.branch = branch
+        self.callback = callback
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.mode = None
+        self._repo = Repo(str(self.git_dir))
+        self._commit = self._current_commit()
+        self._wake_r, self._wake_w = os.pipe()
+        self._stopped = False
+        self._thread = Thread(target=self._run, daemon=True,
+                              name="RefWatcher {}".format(git_dir))
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        os.write(self._wake_w, b"x")
+        self._thread.join()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _current_commit(self):
+        result = self._repo.rev_parse("--verify", "-q",
+                                      "refs/heads/" + self.branch,
+                                      errors_raise=False)
+        return result.stdout.strip() or None
+
+    def _check(self):
+        commit = self._current_commit()
+        if commit != self._commit:
+            log.info("%s: %s moved to %s", self.git_dir, self.branch, commit)
+            self._commit = commit
+            if commit:
+                self.callback()
+
+    def _wait(self, fds, timeout):
+        # returns the readable fds, empty if timed out or stopped
+        readable, _, _ = select.select(fds + [self._wake_r], [], [], timeout)
+        if self._stopped:
+            return []
+        return readable
+
+    def _run(self):
+        inotify = _inotify_init()
+        try:
+            if inotify:
+                self._run_inotify(*inotify)
+            else:
+                self._run_polling()
+        except Exception:
+            log.error("watching %s failed, polling instead", self.git_dir,
+                      exc_info=True)
+            self._run_polling()
+        finally:
+            if inotify:
+                os.close(inotify[1])
+
+    def _run_polling(self):
+        self.mode = "polling"
+        log.info("%s: polling %s every %ss", self.git_dir, self.branch,
+                 self.poll_interval)
+        while not self._stopped:
+            self._wait([], self.poll_interval)
+            if not self._stopped:
+                self._check()
+
+    def _run_inotify(self, libc, fd):
+        ref = Path("refs/heads") / self.branch
+        names = {ref.name.encode(), b"packed-refs"}
+        for d in (self.git_dir, self.git_dir / ref.parent):
+            if not d.is_dir():
+                log.info("%s does not exist (yet), can not watch it", d)
+                return self._run_polling()
+            if libc.inotify_add_watch(fd, str(d).encode(), _WATCH_MASK) < 0:
+                raise OSError(ctypes.get_errno(),
+                              "inotify_add_watch failed", str(d))
+
+        self.mode = "inotify"
+        log.info("%s: watching %s with inotify", self.git_dir, self.branch)
+        self._check()  # might have moved before the watches were there
+        while not self._stopped:
+            if not self._wait([fd], None):
+                continue
+            if not self._relevant(os.read(fd, 64 * 1024), names):
+                continue
+            # debounce: wait until there were no events for a while
+            while self._wait([fd], self.debounce):
+                os.read(fd, 64 * 1024)
+            if not self._stopped:
+                self._check()
+
+    @staticmethod
+    def _relevant(data, names):
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW or name in names:
+                return True
+        return False
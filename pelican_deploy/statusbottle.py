@@ -43,6 +43,27 @@ def set_runners(**name_runner_mapping):
 def set_auth_basic_fn(fn):
     app.config["auth_basic_fn"] = fn
 
+def set_reload_fn(fn):
+    app.config["deploy.reload_fn"] = fn
+
+def _sparkline(values, width=300, height=40):
+    # inline svg line chart, so the status page needs no javascript
+    top = max(values) or 1
+    step = width / max(len(values) - 1, 1)
+    points = " ".join("{:.1f},{:.1f}".format(i * step,
+                                             height - v / top * height)
+                      for i, v in enumerate(values))
+    return ('<svg width="{w}" height="{h}" style="border:1px solid #ccc">'
+            '<polyline fill="none" stroke="black" points="{p}"/></svg>'
+            ).format(w=width, h=height, p=points)
+
+def _timing_trends(timings):
+    trends = {}
+    for t in timings:
+        for step, seconds in t.steps.items():
+            trends.setdefault(step, []).append(seconds)
+    return trends
+
 def _get_runner(name):
     try:
         runners = app.config["deploy.runners"]
@@ -56,6 +77,9 @@ def status():
     tpl = """
     <html>
     <h1>Runners</h1>
+    % if can_reload:
+    <p><a href="reload">reload config</a></p>
+    % end
     <ul>
       % for r in runners:
         <%
@@ -87,7 +111,20 @@ def status():
     </html>
     """
     return template(tpl, runners=app.config["deploy.runners"].values(),
-                    scheds=app.config["deploy.schedulers"])
+                    scheds=app.config["deploy.schedulers"],
+                    can_reload="deploy.reload_fn" in app.config)
+
+@app.route('/reload')
+@_auth_basic
+def reload_config():
+    try:
+        reload_fn = app.config["deploy.reload_fn"]
+    except KeyError:
+        raise HTTPError(status=404, body="reloading is not available")
+
+    if reload_fn():
+        return "Reloaded the config"
+    return "Reloading the config failed, keeping the old one (see log)"
 
 @app.route('/<name>')
 @_auth_basic
@@ -103,9 +140,61 @@ def runnerstatus(name):
     <h1>{{runner.name}} status events ({{start}} - {{end}})</h1>
     <p>
     <a href={{runner.name}}/rerun>(re)start build</a> --
+    <a href={{runner.name}}/abort>abort build</a> --
     <a href={{runner.name}}/clean_working_dir>clean working dir (use e.g. if
-    repository is somehow in a broken state)</a>
+    repository is somehow in a broken state)</a> --
+    <a href={{runner.name}}/maintenance>run maintenance</a>
+    </p>
+    % procs = runner.running_processes()
+    % if procs:
+    <p>
+    Running processes:
+    <ul>
+    % for pid, args in procs:
+        <li>{{pid}}: {{args}}</li>
+    % end
+    </ul>
+    </p>
+    % end
+    % if runner.ref_watcher:
+    <p>Watching {{runner.ref_watcher.git_dir}} for pushes
+    ({{runner.ref_watcher.mode}})</p>
+    % end
+    % du = runner.disk_usage
+    % if du:
+    <p>
+    Disk usage ({{du.date.strftime("%Y-%m-%d %H:%M:%S %Z%z")}}):
+    build repository {{du.build_repo}} bytes (.git {{du.git_dir}} bytes),
+    output {{du.output}} bytes, artifact store {{du.artifacts}} bytes
     </p>
+    % end
+    % rs = runner.repo_stats
+    % if rs:
+    <p>
+    Last repository update: {{"%.1f" % rs.seconds}}s (cloned: {{rs.cloned}}),
+    .git size: {{rs.git_dir_size}} bytes<br>
+    Clone strategy: {{rs.strategy}}
+    </p>
+    % end
+    % store = runner.artifact_store
+    % if store:
+    <p>
+    Artifact store: {{store.count()}} artifacts,
+    {{store.size()}} of {{store.max_size}} bytes used
+    </p>
+    % end
+    % if trends:
+    <h2>Build timings (last {{len(runner.build_timings)}} builds)</h2>
+    <table>
+    % for step, values in sorted(trends.items()):
+        <tr>
+        <td>{{step}}</td>
+        <td>{{!sparkline(values)}}</td>
+        <td>last: {{"%.1f" % values[-1]}}s, max: {{"%.1f" % max(values)}}s</td>
+        </tr>
+    % end
+    </table>
+    % end
     <ul>
     % for bs in islice(reversed(bss),start,end):
         <%
@@ -125,7 +214,9 @@ def runnerstatus(name):
     </html>
     """
     return template(tpl, runner=runner, bss=runner.build_status, islice=islice,
-                    pformat=pformat, start=start, end=end)
+                    pformat=pformat, start=start, end=end,
+                    trends=_timing_trends(runner.build_timings),
+                    sparkline=_sparkline)
 
 @_auth_basic
 @app.route('/<name>/rerun')
@@ -140,3 +231,18 @@ def rerun(name):
     runner = _get_runner(name)
     runner.clean_working_dir()
     return "Invoked cleaning of working dir"
+
+@app.route('/<name>/abort')
+@_auth_basic
+def abort(name):
+    runner = _get_runner(name)
+    runner.try_abort_build()
+    return "Aborting the build, see the status page for the result"
+
+@app.route('/<name>/maintenance')
+@_auth_basic
+def maintenance(name):
+    runner = _get_runner(name)
+    if runner.maintain():
+        return "Invoked maintenance"
+    return "Runner is busy, maintenance skipped"
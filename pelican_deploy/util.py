@@ -12,6 +12,16 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from subprocess import Popen
+from threading import Lock
+import os
+import signal
+import time
+
+# after SIGKILL, wait at most that long for the process group to vanish
+KILL_TIMEOUT = 5
+POLL_INTERVAL = 0.1
+
 
 def exception_logged(func, log):
     def wrapped(*args, **kwargs):
@@ -21,3 +31,115 @@ def exception_logged(func, log):
             log("Caught Exception!", exc_info=True)
             raise # reraise
     return wrapped
+
+def dir_size(path):
+    # sum of the sizes of all files below path, symlinks are not followed
+    total = 0
+    for root, dirs, files in os.walk(str(path)):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except FileNotFoundError:
+                pass  # removed while walking
+    return total
+
+class AbortedError(Exception):
+    pass
+
+def _group_alive(proc):
+    proc.poll()  # reap it, if it is done and nobody else waits for it
+    try:
+        os.killpg(proc.pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _signal_group(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+def _wait_groups(procs, timeout):
+    deadline = time.monotonic() + timeout
+    alive = [p for p in procs if _group_alive(p)]
+    while alive and time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        alive = [p for p in alive if _group_alive(p)]
+    return alive
+
+class ProcessRegistry:
+    # Keeps track of the running subprocesses of a runner. Each one is
+    # started in its own session, so the pid is also the process group id
+    # and terminate reaches all children (tox, pelican, plugins, ...).
+    # After abort no new processes are started until reopen().
+
+    def __init__(self):
+        self._lock = Lock()
+        self._procs = set()
+        self.aborted = False
+
+    def reopen(self):
+        with self._lock:
+            self.aborted = False
+
+    def popen(self, args, **kwargs):
+        with self._lock:
+            if self.aborted:
+                raise AbortedError("aborted, not starting {}".format(args))
+            proc = Popen(args, start_new_session=True, **kwargs)
+            self._procs.add(proc)
+        return proc
+
+    def add(self, proc):
+        # for processes not started by popen, needs pid, args and poll()
+        with self._lock:
+            if self.aborted:
+                raise AbortedError("aborted, not adding {}".format(proc.args))
+            self._procs.add(proc)
+
+    def release(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+
+    def run(self, args, **kwargs):
+        proc = self.popen(args, **kwargs)
+        try:
+            outs, errs = proc.communicate()
+            return proc.wait(), outs, errs
+        finally:
+            self.release(proc)
+
+    def running(self):
+        with self._lock:
+            return [(p.pid, p.args) for p in self._procs]
+
+    def abort(self):
+        # returns the running processes, pass them to terminate
+        with self._lock:
+            self.aborted = True
+            return list(self._procs)
+
+    @staticmethod
+    def terminate(procs, grace_period):
+        # SIGTERM to every process group, SIGKILL to the ones still there
+        # after grace_period. Returns a dict pid -> "terminated", "killed"
+        # or "not terminated" (if even SIGKILL did not help in time)
+        result = {}
+        for proc in procs:
+            _signal_group(proc, signal.SIGTERM)
+        alive = _wait_groups(procs, grace_period)
+        for proc in alive:
+            _signal_group(proc, signal.SIGKILL)
+        still_alive = _wait_groups(alive, KILL_TIMEOUT)
+
+        for proc in procs:
+            if proc in still_alive:
+                result[proc.pid] = "not terminated"
+            elif proc in alive:
+                result[proc.pid] = "killed"
+            else:
+                result[proc.pid] = "terminated"
+        return result